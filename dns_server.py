@@ -1,90 +1,91 @@
 import atexit
-import ipaddress
-import json
+import os
+import pickle
 import random
 import socket
 import socketserver
 import struct
+import sys
 import time
-from queue import Queue
-from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from queue import Empty, LifoQueue
+from threading import Lock, local
 
+# bound once so hot paths skip the module-attribute lookups
+_monotonic = time.monotonic
+_getrandbits = random.getrandbits
 
-class CashRecord:
-    def __init__(self, request: str, response: str, let: float):
-        self.request = request
-        self.response = response
-        self.let = let
-        self.r = True
 
-    def to_dict(self):
-        return {'response': self.response, 'let': self.let, 'r': self.r}
+class ShardedCash:
+    shard_count = 16
 
-
-class Cash:
     def __init__(self, maxsize=100):
-        self.queue = Queue(maxsize=maxsize)
-        self.records = {}
-        self.lock = Lock()
+        self.maxsize = maxsize
+        self.shard_size = maxsize // self.shard_count or (1 if maxsize else 0)
+        self.shards = [(Lock(), OrderedDict()) for _ in range(self.shard_count)]
         try:
             self.restore()
         except FileNotFoundError:
             pass
         atexit.register(self.save)
 
-    def get(self, key):
-        self.lock.acquire()
-        if not key or key not in self.records:
+    def get(self, key: bytes):
+        lock, records = self.shards[hash(key) & (self.shard_count - 1)]
+        # dict reads are atomic under the GIL, so hits pay no lock at all;
+        # reading an entry that a concurrent put just evicted is harmless
+        record = records.get(key)
+        if record is None:
+            return None
+        response, let, ttl_off = record
+        now = _monotonic()
+        if let <= now:
+            with lock:
+                records.pop(key, None)
             return None
-        record = self.records[key]
-        record.r = True
-        self.lock.release()
-        return record.response.encode()
-
-    def put(self, request: bytes, response: bytes, ttl: float):
-        request = request.decode(errors='ignore')
-        response = response.decode(errors='ignore')
-        self.lock.acquire()
-        if self.queue.maxsize == 0:
+        if ttl_off is None:
+            return response
+        # patch the remaining lifetime into the TTL field so clients
+        # do not re-cache the original, by now stale, TTL
+        patched = bytearray(response)
+        patched[ttl_off: ttl_off + 4] = struct.pack('>I', int(let - now))
+        return bytes(patched)
+
+    def put(self, request: bytes, response: bytes, ttl: float, ttl_off=None):
+        if self.shard_size == 0:
             return
-        while self.queue.full():
-            record = self.queue.get()
-            if record.r and record.let > time.time():
-                record.r = False
-                self.queue.put(record)
-            else:
-                self.records.pop(record.request)
-        record = CashRecord(request, response, ttl + time.time())
-        self.records[request] = record
-        self.queue.put(record)
-        self.lock.release()
+        lock, records = self.shards[hash(request) & (self.shard_count - 1)]
+        with lock:
+            if len(records) >= self.shard_size:
+                records.popitem(last=False)
+            records[request] = (response, ttl + _monotonic(), ttl_off)
+            records.move_to_end(request)
 
     def restore(self):
-        with open('cash.json', 'r+') as file:
-            data = file.read()
-            dict = json.loads(data)
-            for request in dict:
-                record = CashRecord(request, dict[request]['response'], dict[request]['let'])
-                record.r = dict[request]['r']
-                if record.let < time.time():
-                    continue
-                self.records[request] = record
-                self.queue.put(record)
+        with open('cash.pkl', 'rb') as file:
+            records = pickle.load(file)
+        shift = time.monotonic() - time.time()
+        for request, (response, let, ttl_off) in records.items():
+            let += shift
+            if let <= time.monotonic():
+                continue
+            self.shards[hash(request) & (self.shard_count - 1)][1][request] = \
+                (response, let, ttl_off)
 
     def save(self):
-        dict = {}
-        for record in self.records:
-            dict[record] = self.records[record].to_dict()
-        with open('cash.json', 'w+') as file:
-            file.write(json.dumps(dict))
+        records = {}
+        shift = time.time() - time.monotonic()
+        for _, shard in self.shards:
+            for request, (response, let, ttl_off) in shard.items():
+                records[request] = (response, let + shift, ttl_off)
+        with open('cash.pkl.tmp', 'wb') as file:
+            pickle.dump(records, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace('cash.pkl.tmp', 'cash.pkl')
 
     def __contains__(self, item):
-        if item not in self.records:
-            return False
-        if self.records[item].let < time.time():
-            self.records.pop(item)
-            return False
-        return True
+        record = self.shards[hash(item) & (self.shard_count - 1)][1].get(item)
+        return record is not None and record[1] > _monotonic()
 
 
 class DnsRequestGenerator:
@@ -94,33 +95,27 @@ class DnsRequestGenerator:
         'MX': 15,
         'NS': 2
     }
+    # id, flags=0, qdcount=1, an/ns/arcount=0
+    _pack_header = struct.Struct('>HHHHHH').pack
+    _pack_question = struct.Struct('>HH').pack
 
     def generate_request(self, url, r_type):
-        header = self.__generate_header__(0, 0)
+        header = self._pack_header(_getrandbits(16), 0, 1, 0, 0, 0)
         body = self.__generate_body__(url, r_type)
-        return b''.join([header, body])
-
-    def __generate_header__(self, opcode, rd):
-        id = struct.pack('>H', random.randint(0, 65535))
-        flags = struct.pack('>H', (((opcode << 3) + rd) << 8))
-        qdcount = struct.pack('>H', 1)
-        ancount = struct.pack('>H', 0)
-        nscount = struct.pack('>H', 0)
-        arcount = struct.pack('>H', 0)
-        return b''.join([id, flags, qdcount, ancount, nscount, arcount])
+        return header + body
 
+    @lru_cache(maxsize=1024)
     def __generate_body__(self, url, r_type):
         if r_type not in self.qtypes:
             raise ValueError(f'Incorrect request type: {r_type}')
-        body = []
-        labels = url.split('.')
-        for label in labels:
-            body.append(struct.pack('>B', len(label)))
-            body.append(label.encode())
-        body.append(struct.pack('>B', 0))
-        body.append(struct.pack('>H', self.qtypes[r_type]))
-        body.append(struct.pack('>H', 1))
-        return b''.join(body)
+        body = bytearray()
+        for label in url.split('.'):
+            label = label.encode('ascii')
+            body.append(len(label))
+            body.extend(label)
+        body.append(0)
+        body += self._pack_question(self.qtypes[r_type], 1)
+        return bytes(body)
 
 
 class DnsResponseParser:
@@ -131,99 +126,112 @@ class DnsResponseParser:
         2: 'NS',
         41: 'OPT'
     }
-    flags = [('QR', 1), ('Opcode', 4), ('AA', 1), ('TC', 1),
-             ('RD', 1), ('RA', 1), ('Z', 3), ('RCODE', 4)]
+    _unpack_h = struct.Struct('>H').unpack_from
+    _unpack_i = struct.Struct('>I').unpack_from
+    _unpack_header = struct.Struct('>HHHHHH').unpack_from
+    # nameserver labels repeat across sections; reuse their decoded form
+    _label_cache = {}
 
     def parse_response(self, response):
-        result = {'header': self.__parse_header__(response[:12])}
-        result['body'] = self.__parse_body__(response[12:], result['header'])
+        data = memoryview(response)
+        result = {'header': self.__parse_header__(data)}
+        result['body'] = self.__parse_body__(data, result['header'])
         return result
 
-    def __parse_header__(self, header):
-        result = {}
-        id, flags, qd, an, ns, ar = struct.unpack(">HHHHHH", header)
-        result['id'] = id
-        for i in range(len(self.flags) - 1, -1, -1):
-            result[self.flags[i][0]] = flags % 2 ** self.flags[i][1]
-            flags //= 2 ** self.flags[i][1]
-        result['qdcount'] = qd
-        result['ancount'] = an
-        result['nscount'] = ns
-        result['arcount'] = ar
-        return result
+    def __parse_header__(self, data):
+        id, flags, qd, an, ns, ar = self._unpack_header(data, 0)
+        return {'id': id,
+                'QR': flags >> 15 & 1, 'Opcode': flags >> 11 & 15,
+                'AA': flags >> 10 & 1, 'TC': flags >> 9 & 1,
+                'RD': flags >> 8 & 1, 'RA': flags >> 7 & 1,
+                'Z': flags >> 4 & 7, 'RCODE': flags & 15,
+                'qdcount': qd, 'ancount': an, 'nscount': ns, 'arcount': ar}
 
     def __parse_body__(self, data, header):
         result = {}
-        sections = {
-            'question': header['qdcount'],
-            'answer': header['ancount'],
-            'authority': header['nscount'],
-            'additional': header['arcount']
-        }
-        cursor = 0
-        for section in sections:
-            for i in range(sections[section]):
-                if section not in result:
-                    result[section] = []
-                sec, cursor = self.__parse_record__(data, cursor)
-                result[section].append(sec)
+        cursor = 12
+        qd = header['qdcount']
+        if qd:
+            section = result['question'] = [None] * qd
+            for i in range(qd):
+                section[i], cursor = self.__get_question_section__(data, cursor)
+        for name, count in (('answer', header['ancount']),
+                            ('authority', header['nscount']),
+                            ('additional', header['arcount'])):
+            if count:
+                section = result[name] = [None] * count
+                for i in range(count):
+                    section[i], cursor = self.__parse_record__(data, cursor)
         return result
 
     def __get_question_section__(self, data, cursor):
-        d = data[cursor:]
         section = {}
         section['name'], cursor = self.__read_name__(data, cursor)
-        cursor += 1
-        n = data[cursor: cursor + 2]
-        section['type'] = self.qtypes[struct.unpack('>H', data[cursor: cursor + 2])[0]]
+        # unknown types stay numeric, like record types do
+        type_code = self._unpack_h(data, cursor)[0]
+        section['type'] = self.qtypes.get(type_code, type_code)
         cursor += 2
-        section['class'] = struct.unpack('>H', data[cursor: cursor + 2])[0]
+        section['class'] = self._unpack_h(data, cursor)[0]
         cursor += 2
         return section, cursor
 
-    def __parse_record__(self, data: bytes, cursor: int):
+    def __parse_record__(self, data, cursor: int):
         record = {}
-        if data[cursor] == 192:
-            start_index = data[cursor + 1] - 12
-            record['name'], _ = self.__read_name__(data, start_index)
-            cursor += 2
-            record['type'] = struct.unpack('>H', data[cursor: cursor + 2])[0]
-            cursor += 2
-            record['class'] = struct.unpack('>H', data[cursor: cursor + 2])[0]
-            cursor += 2
-            record['ttl'] = struct.unpack('>I', data[cursor: cursor + 4])[0]
-            cursor += 4
-            size = struct.unpack('>H', data[cursor: cursor + 2])[0]
-            cursor += 2
-            record['data'] = self.__parse_data__(data, cursor, size, record['type'])
-            cursor += size
-            return record, cursor
-        return self.__get_question_section__(data, cursor)
+        record['name'], cursor = self.__read_name__(data, cursor)
+        record['type'] = self._unpack_h(data, cursor)[0]
+        cursor += 2
+        record['class'] = self._unpack_h(data, cursor)[0]
+        cursor += 2
+        record['ttl'] = self._unpack_i(data, cursor)[0]
+        cursor += 4
+        size = self._unpack_h(data, cursor)[0]
+        cursor += 2
+        record['data'] = self.__parse_data__(data, cursor, size, record['type'])
+        cursor += size
+        return record, cursor
 
     def __read_name__(self, data, cursor, size=0):
         name = []
         end_index = cursor + size
+        jumped = False
         while data[cursor] != 0 and (not size or cursor < end_index):
-            if data[cursor] == 192:
-                name_size = data[cursor + 1]
-                label, _ = self.__read_name__(data, name_size - 12)
-                name.append(label)
-                cursor += 2
-                break
+            if data[cursor] >= 192:
+                # 14-bit compression pointer: the high two bits mark the
+                # pointer, the rest is an absolute offset into the packet
+                if not jumped:
+                    end_index = cursor + 2
+                    jumped = True
+                    visited = {cursor}
+                elif cursor in visited:
+                    raise ValueError('compression pointer loop')
+                else:
+                    visited.add(cursor)
+                cursor = (data[cursor] & 0x3F) << 8 | data[cursor + 1]
+                size = 0
+                continue
             label_size = data[cursor]
-            label = data[cursor + 1: cursor + label_size + 1].decode()
+            raw = bytes(data[cursor + 1: cursor + label_size + 1])
+            label = self._label_cache.get(raw)
+            if label is None:
+                if len(self._label_cache) > 4096:
+                    self._label_cache.clear()
+                label = self._label_cache.setdefault(raw, raw.decode())
             name.append(label)
             cursor += label_size + 1
-        return '.'.join(name), cursor
+        if jumped:
+            return sys.intern('.'.join(name)), end_index
+        if data[cursor] == 0:
+            cursor += 1
+        return sys.intern('.'.join(name)), cursor
 
     def __parse_ip__(self, data, cursor, size):
-        return str(ipaddress.IPv4Address(data[cursor: cursor + size]))
+        return socket.inet_ntop(socket.AF_INET, bytes(data[cursor: cursor + size]))
 
     def __parse_ipv6__(self, data, cursor, size):
-        return str(ipaddress.IPv6Address(data[cursor: cursor + size]))
+        return socket.inet_ntop(socket.AF_INET6, bytes(data[cursor: cursor + size]))
 
     def __parse_mx__(self, data, cursor, size):
-        preference = struct.unpack('>H', data[cursor: cursor + 2])[0]
+        preference = self._unpack_h(data, cursor)[0]
         mail_exchange, _ = self.__read_name__(data, cursor + 2, size - 2)
         return ' '.join([str(preference), mail_exchange])
 
@@ -258,12 +266,78 @@ root_server_addresses = [
 
 root_server_address = ('198.41.0.4', 53)
 
+_thread_state = local()
+
+_buffer_pool = LifoQueue()
+for _ in range(64):
+    _buffer_pool.put(bytearray(4096))
+
+
+def _get_buffer():
+    try:
+        return _buffer_pool.get_nowait()
+    except Empty:
+        return bytearray(4096)
+
+
+def qkey(buf):
+    """Cache key: the QNAME+QTYPE+QCLASS byte slice of a query packet.
+
+    The name part is lowercased so 0x20-randomized or mixed-case queries
+    share one entry; label length bytes (<= 63) sit below the ASCII
+    letters, so lower() only ever touches the name characters.  The
+    type/class words are appended unfolded: QTYPE values from 65 up land
+    in the uppercase range (HTTPS is 65, 'A') and must not collide with
+    the types 32 below them.
+    """
+    i = 12
+    while buf[i]:
+        i += buf[i] + 1
+    return bytes(buf[12:i]).lower() + bytes(buf[i:i + 5])
+
+
+def fast_ttl(raw):
+    """Find the first answer's TTL and its offset without a full parse."""
+    if struct.unpack_from('>H', raw, 6)[0] == 0:
+        return None, None
+    cursor = 12
+    while raw[cursor]:
+        cursor += raw[cursor] + 1
+    cursor += 5
+    # the answer's owner name may mix inline labels with a trailing pointer
+    while raw[cursor] and raw[cursor] < 192:
+        cursor += raw[cursor] + 1
+    cursor += 2 if raw[cursor] >= 192 else 1
+    return struct.unpack_from('>I', raw, cursor + 4)[0], cursor + 4
+
+
+def _upstream_socket():
+    sock = getattr(_thread_state, 'socket', None)
+    if sock is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(10)
+        _thread_state.socket = sock
+    return sock
+
 
 class ThreadingDnsServer(socketserver.ThreadingUDPServer):
-    def __init__(self, host, cash_size=0):
-        self.cash = Cash(cash_size)
+    def __init__(self, host, cash_size=0, max_workers=64, cash=None):
+        self.cash = cash if cash is not None else ShardedCash(cash_size)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
         super().__init__((host, 53), DnsRequestHandler)
 
+    def process_request(self, request, client_address) -> None:
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+    def server_bind(self) -> None:
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
     def finish_request(self, request, client_address) -> None:
         self.RequestHandlerClass(request, client_address, self, self.cash)
 
@@ -271,37 +345,79 @@ class ThreadingDnsServer(socketserver.ThreadingUDPServer):
 class DnsRequestHandler(socketserver.DatagramRequestHandler):
 
     def __init__(self, request, client_address, server, cash):
-        self.request_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.request_socket.settimeout(10)
+        self.request_socket = _upstream_socket()
         self.cash = cash
         super().__init__(request, client_address, server)
 
+    def finish(self) -> None:
+        # dropped queries would otherwise still answer with an empty datagram
+        if self.wfile.getbuffer().nbytes:
+            super().finish()
+
     def handle(self) -> None:
-        data = self.rfile.read(2048)
-        key = data[2:].decode(errors='ignore')
-        if key in self.cash:
-            self.wfile.write(data[:2] + self.cash.get(key))
+        data = self.packet
+        # cheaply drop runts and multi-question packets instead of
+        # raising out of the handler for every junk datagram
+        if len(data) < 17 or data[4:6] != b'\x00\x01':
+            return
+        try:
+            key = qkey(data)
+        except IndexError:
+            return
+        response = self.cash.get(key)
+        if response is not None:
+            self.wfile.write(data[:2] + response)
             return
         for i in range(len(root_server_addresses)):
             try:
-                parsed_answer, raw_answer = self.__get_answer__(data, root_server_addresses[i])
+                raw_answer = self.__get_answer__(data, root_server_addresses[i])[1]
                 break
             except socket.timeout:
                 if i == len(root_server_addresses) - 1:
-                    self.request_socket.close()
                     return
-        self.cash.put(data[2:], raw_answer[2:], parsed_answer['body']['answer'][0]['ttl'])
+        try:
+            ttl, ttl_off = fast_ttl(raw_answer)
+        except (IndexError, struct.error):
+            ttl = ttl_off = None
+        rcode = raw_answer[3] & 15
+        if ttl is not None:
+            # the cached payload starts after the 2-byte id
+            self.cash.put(key, raw_answer[2:], ttl, ttl_off - 2)
+        elif rcode == 3 or (rcode == 0 and raw_answer[8:10] != b'\x00\x00'):
+            # negative-cache NXDOMAIN and NODATA (SOA-only authority)
+            # so repeat misses stay local
+            self.cash.put(key, raw_answer[2:], 60)
         self.wfile.write(raw_answer)
-        self.request_socket.close()
 
     def __get_answer__(self, request, target):
         while True:
             self.request_socket.sendto(request, target)
-            raw_response, server = self.request_socket.recvfrom(4096)
-            parsed_response = response_parser.parse_response(raw_response)
-            body = parsed_response['body']
-            if 'answer' in body:
-                break
+            buffer = _get_buffer()
+            try:
+                while True:
+                    length = self.request_socket.recvfrom_into(buffer)[0]
+                    # a reused socket can still hold late replies to queries
+                    # that already timed out; match on the transaction id
+                    if buffer[:2] == request[:2]:
+                        break
+                data = memoryview(buffer)[:length]
+                parsed_response = response_parser.parse_response(data)
+                body = parsed_response['body']
+                referral = None
+                if 'authority' in body:
+                    for record in body['authority']:
+                        if record['type'] == 2:
+                            referral = record['data']
+                            break
+                has_referral = (('additional' in body and len(body['additional']) > 1)
+                                or referral is not None)
+                if 'answer' in body or parsed_response['header']['RCODE'] or not has_referral:
+                    # answers, error responses and NODATA replies whose
+                    # authority holds no NS to chase (SOA only) are all
+                    # terminal; only they leave the buffer pool as real bytes
+                    return parsed_response, bytes(data)
+            finally:
+                _buffer_pool.put(buffer)
             if 'additional' in body and len(body['additional']) > 1:
                 for record in body['additional']:
                     if record['type'] == 1:
@@ -310,6 +426,5 @@ class DnsRequestHandler(socketserver.DatagramRequestHandler):
             else:
                 target = (
                     self.__get_answer__(
-                        request_generator.generate_request(body['authority'][0]['data'], 'A'),
+                        request_generator.generate_request(referral, 'A'),
                         root_server_address)[0]['body']['answer'][0]['data'], 53)
-        return parsed_response, raw_response
@@ -1,5 +1,11 @@
-from dns_server import ThreadingDnsServer
+import os
+from threading import Thread
+
+from dns_server import ShardedCash, ThreadingDnsServer
 
 if __name__ == '__main__':
-    with ThreadingDnsServer('localhost', 10) as server:
-        server.serve_forever()
+    cash = ShardedCash(10)
+    servers = [ThreadingDnsServer('localhost', cash=cash) for _ in range(os.cpu_count())]
+    for server in servers[1:]:
+        Thread(target=server.serve_forever, daemon=True).start()
+    servers[0].serve_forever()